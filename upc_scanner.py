@@ -1,39 +1,121 @@
 import streamlit as st
-from pyzbar.pyzbar import decode
-import pytesseract
-from PIL import Image, ImageOps, ImageEnhance
+from pyzbar.pyzbar import decode, ZBarSymbol
+from tesserocr import PyTessBaseAPI, PSM, OEM
+from PIL import Image, ImageOps
+import numpy as np
+import cv2
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from google.oauth2.service_account import Credentials
 import re
+import io
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # --- CONFIGURATION ---
 SHEET_NAME = "My Collection"
+AUTO_SYNC_AT = 5  # queued cars that trigger a save without pressing the button
+# Model codes are only A-Z / 0-9 / dash, so don't let Tesseract consider anything else
+OCR_WHITELIST = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-"
+MODEL_CODE_RE = re.compile(r'[A-Z0-9]{5}-[A-Z0-9]{4}')
+HTTP_TIMEOUT = (3, 7)  # (connect, read) seconds per attempt; see get_http_session() for retries
+# Product barcodes only; zbar skips the QR/CODE128/... decoders entirely
+UPC_SYMBOLS = [ZBarSymbol.UPCA, ZBarSymbol.UPCE, ZBarSymbol.EAN13, ZBarSymbol.EAN8]
+# Where things print on a standard card back, as (left, top, right, bottom) fractions
+BARCODE_ROI = (0.0, 0.6, 0.5, 1.0)
+CODE_ROI = (0.5, 0.7, 1.0, 1.0)
+
+# --- HTTP SESSION ---
+# One pooled session per process so lookups reuse the TCP/TLS connection.
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    # Retry transient 5xx and one failed connect. Never retry a read timeout (a dead
+    # upstream would hold the page for 3x the timeout) or a 429 (the trial endpoint
+    # would just reject it again and burn quota).
+    retry = Retry(total=2, connect=1, read=0, backoff_factor=0.3,
+                  status_forcelist=[500, 502, 503, 504],
+                  respect_retry_after_header=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = "Mozilla/5.0"
+    return session
+
+SESSION = get_http_session()
+
+# --- BACKGROUND WORKERS ---
+# Shared across reruns so in-flight work survives Streamlit restarting the script.
+@st.cache_resource
+def get_executor():
+    return ThreadPoolExecutor(max_workers=8)
+
+EXECUTOR = get_executor()
+
+def submit_lookup(fn, code):
+    """Reuses an identical lookup that's already in flight instead of firing a second one."""
+    inflight = st.session_state.setdefault('inflight', {})
+    key = (fn.__name__, code)
+    fut = inflight.get(key)
+    if fut is None:
+        fut = EXECUTOR.submit(fn, code)
+        inflight[key] = fut
+        fut.add_done_callback(lambda _: inflight.pop(key, None))
+    return fut
+
+# --- OCR ENGINE ---
+# Keeps libtesseract and its language model loaded between scans.
+# The API object isn't re-entrant, so every call goes through the lock.
+@st.cache_resource
+def get_ocr_engine():
+    api = PyTessBaseAPI(lang="eng", psm=PSM.SPARSE_TEXT, oem=OEM.LSTM_ONLY)
+    api.SetVariable("tessedit_char_whitelist", OCR_WHITELIST)
+    return api, threading.Lock()
+
+TESS, TESS_LOCK = get_ocr_engine()
 
 # --- GOOGLE SHEETS SETUP ---
+SCOPES = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+
+# Parsing the service-account RSA key is slow, so do it once per process.
+# google-auth refreshes the access token on its own.
+@st.cache_resource
+def get_credentials():
+    return Credentials.from_service_account_info(dict(st.secrets["gcp_service_account"]), scopes=SCOPES)
+
+@st.cache_resource
+def get_client():
+    return gspread.authorize(get_credentials())
+
+# Cached so we don't redo the Drive lookup of the sheet on every save.
+# Failures raise instead of returning None, so a bad connection never gets cached.
+@st.cache_resource(ttl=3000, show_spinner=False)
 def get_sheet_connection():
-    try:
-        scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-        creds_dict = st.secrets["gcp_service_account"]
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-        client = gspread.authorize(creds)
-        return client.open(SHEET_NAME).sheet1
-    except Exception as e:
-        return None
+    return get_client().open(SHEET_NAME).sheet1
 
-def save_to_sheet(car):
-    sheet = get_sheet_connection()
-    if not sheet:
+def build_row(car):
+    image_formula = f'=IMAGE("{car["image"]}")' if car["image"] else ""
+    return [car['title'], car['brand'], image_formula, car['upc'], car['model_code']]
+
+def save_to_sheet(rows):
+    """Writes all queued rows in a single append_rows call (one API round-trip)."""
+    try:
+        sheet = get_sheet_connection()
+    except Exception:
         return False, "❌ Error: Could not connect to Google Sheet."
     try:
-        image_formula = f'=IMAGE("{car["image"]}")' if car["image"] else ""
-        row = [car['title'], car['brand'], image_formula, car['upc'], car['model_code']]
-        sheet.append_row(row, value_input_option='USER_ENTERED')
-        return True, f"✅ Parked '{car['title']}'!"
+        sheet.append_rows(rows, value_input_option='USER_ENTERED')
+        return True, f"✅ Parked {len(rows)} car(s)!"
     except Exception as e:
+        # The cached handle may have gone stale; reopen it on the next try
+        get_sheet_connection.clear()
         return False, f"❌ Cloud Error: {e}"
 
 # --- OFFICIAL WIKI API (The "Secret Door") ---
+@st.cache_data(ttl=86400, max_entries=1024, show_spinner=False)
 def search_wiki_api(code):
     """Asks the Wiki API directly for the page title. No scraping."""
     
@@ -49,61 +131,140 @@ def search_wiki_api(code):
         "format": "json",
         "list": "search",
         "srsearch": clean_code,  # What we are looking for
-        "srlimit": 1             # Just give us the #1 best match
+        "srlimit": 1,            # Just give us the #1 best match
+        "srprop": ""             # We only need the title, skip snippets/sizes
     }
     
-    try:
-        response = requests.get(url, params=params)
-        data = response.json()
-        
-        # Dig into the JSON response
-        if "query" in data and "search" in data["query"]:
-            results = data["query"]["search"]
-            if len(results) > 0:
-                # The 'title' of the page is usually the car name!
-                # e.g. "Mazda Savanna RX-7 FC3S (2025)"
-                title = results[0]["title"]
-                
-                # Construct a clean link to that page
-                # Wiki titles use underscores instead of spaces in URLs
-                wiki_link = f"https://hotwheels.fandom.com/wiki/{title.replace(' ', '_')}"
-                
-                return title, wiki_link
-    except:
-        pass
+    # No try/except: errors propagate so st.cache_data only keeps real answers
+    response = SESSION.get(url, params=params, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    # MediaWiki reports API errors with HTTP 200 and an "error" key
+    if "error" in data:
+        raise RuntimeError(f"Wiki API error: {data['error'].get('info', data['error'])}")
+    
+    # Dig into the JSON response
+    if "query" in data and "search" in data["query"]:
+        results = data["query"]["search"]
+        if len(results) > 0:
+            # The 'title' of the page is usually the car name!
+            # e.g. "Mazda Savanna RX-7 FC3S (2025)"
+            title = results[0]["title"]
+            
+            # Construct a clean link to that page
+            # Wiki titles use underscores instead of spaces in URLs
+            wiki_link = f"https://hotwheels.fandom.com/wiki/{title.replace(' ', '_')}"
+            
+            return title, wiki_link
         
     return None, None
 
 # --- UPC LOGIC ---
+# Cached per code: rescans of the same card shouldn't burn UPCitemdb's trial quota.
+# Errors propagate so they never get cached; a plain "not found" does.
+@st.cache_data(ttl=86400, max_entries=1024, show_spinner=False)
 def lookup_upc(upc_code):
     url = "https://api.upcitemdb.com/prod/trial/lookup"
-    try:
-        response = requests.get(url, params={"upc": upc_code})
-        data = response.json()
-        if "items" in data and len(data["items"]) > 0:
-            item = data["items"][0]
-            return {
-                "title": item.get("title", ""),
-                "brand": item.get("brand", "Hot Wheels"),
-                "image": item.get("images", [""])[0] if item.get("images") else "",
-                "upc": upc_code
-            }
-    except:
-        pass
+    response = SESSION.get(url, params={"upc": upc_code}, timeout=HTTP_TIMEOUT)
+    # 429 TOO_FAST etc. come back as JSON without "items"; don't mistake them for "not found"
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    if "items" in data and len(data["items"]) > 0:
+        item = data["items"][0]
+        return {
+            "title": item.get("title", ""),
+            "brand": item.get("brand", "Hot Wheels"),
+            "image": item.get("images", [""])[0] if item.get("images") else "",
+            "upc": upc_code
+        }
     return {"title": "", "brand": "Hot Wheels", "image": "", "upc": upc_code}
 
-def extract_model_code(image):
-    gray = ImageOps.grayscale(image)
-    enhancer = ImageEnhance.Contrast(gray)
-    clean_img = enhancer.enhance(2.5)
-    text = pytesseract.image_to_string(clean_img)
+def read_model_code(gray):
+    # Local contrast (CLAHE) copes with glare and dim blister labels better than a global bump
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    gray = clahe.apply(gray)
+    # Per-neighbourhood threshold: one global cut-off can't handle uneven card lighting
+    binary = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                   cv2.THRESH_BINARY, 31, 10)
+    clean_img = Image.fromarray(binary)
+    with TESS_LOCK:
+        TESS.SetImage(clean_img)
+        text = TESS.GetUTF8Text()
     
-    pattern = r'[A-Z0-9]{5}-[A-Z0-9]{4}'
-    match = re.search(pattern, text)
+    match = MODEL_CODE_RE.search(text)
     if match:
         return match.group(0)
     return None
 
+def crop_fraction(arr, box):
+    """Slices a fractional (left, top, right, bottom) box out of an image array (a view)."""
+    h, w = arr.shape[:2]
+    return arr[int(box[1] * h):int(box[3] * h), int(box[0] * w):int(box[2] * w)]
+
+def find_barcodes(gray, fast=True):
+    """Scans the usual barcode corner first in fast mode, then the whole card."""
+    if fast:
+        decoded_objects = decode(crop_fraction(gray, BARCODE_ROI), symbols=UPC_SYMBOLS)
+        if decoded_objects:
+            return decoded_objects
+    return decode(gray, symbols=UPC_SYMBOLS)
+
+def extract_model_code(gray, fast=True):
+    """OCRs the usual model-code corner first in fast mode, then the whole card.
+
+    Takes the shared 2-D uint8 grayscale array; the ROI is a view, not a copy.
+    """
+    if fast:
+        code = read_model_code(crop_fraction(gray, CODE_ROI))
+        if code:
+            return code
+    return read_model_code(gray)
+
+# --- SCAN PIPELINE ---
+# Keyed on the upload's bytes, so reruns (every keystroke) reuse the results
+# instead of re-decoding and re-scanning the same photo.
+@st.cache_data(show_spinner=False, max_entries=16)
+def prepare_upload(file_bytes, fast=True):
+    """Returns (display image, grayscale array, UPC or None) for an uploaded photo."""
+    image = Image.open(io.BytesIO(file_bytes))
+    if max(image.size) > 1000:
+        # JPEGs: let libjpeg decode at 1/2, 1/4 or 1/8 scale straight from the DCT data
+        ratio = 1000 / max(image.size)
+        image.draft("RGB", (int(image.width * ratio), int(image.height * ratio)))
+        # Bilinear is plenty for feeding zbar/Tesseract and much cheaper than the default
+        image.thumbnail((1000, 1000), resample=Image.Resampling.BILINEAR)
+    # Rotate after shrinking so we don't spin a 12MP phone photo
+    image = ImageOps.exif_transpose(image)
+    
+    # One grayscale buffer shared by zbar and Tesseract
+    gray_arr = np.asarray(image.convert("L"))
+
+    # zbar works on luminance anyway; hand it a smaller 8-bit copy (no PIL round trip)
+    scale = 800 / max(gray_arr.shape)
+    decode_arr = gray_arr
+    if scale < 1:
+        decode_arr = cv2.resize(gray_arr, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    decoded_objects = find_barcodes(decode_arr, fast=fast)
+    found_upc = decoded_objects[0].data.decode("utf-8") if decoded_objects else None
+    return image, gray_arr, found_upc
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def read_upload_code(file_bytes, fast=True):
+    """OCRs an upload's model code. Separate from prepare_upload so UPC hits never pay for it."""
+    _, gray_arr, _ = prepare_upload(file_bytes, fast)
+    return extract_model_code(gray_arr, fast=fast)
+
+def show_wiki_result(wiki_title, wiki_link):
+    """Renders a finished wiki lookup and fills in the name if it's still empty."""
+    if wiki_title:
+        st.success(f"✨ Identified: {wiki_title}")
+        if not st.session_state['current_car']['title']:
+            st.session_state['current_car']['title'] = wiki_title
+        st.markdown(f"[View Wiki Page]({wiki_link})")
+    else:
+        st.warning("Code valid, but no exact Wiki match found.")
+
 # --- APP INTERFACE ---
 st.title("🏎️ HW Bot Scanner (API Edition)")
 
@@ -111,48 +272,89 @@ if 'current_car' not in st.session_state:
     st.session_state['current_car'] = {
         "title": "", "brand": "Hot Wheels", "image": "", "upc": "", "model_code": ""
     }
+if 'pending_rows' not in st.session_state:
+    st.session_state['pending_rows'] = []
+if 'wiki_results' not in st.session_state:
+    st.session_state['wiki_results'] = {}  # model code -> (title, link)
 
 st.info("Upload card back. We use the Official Wiki API to find the name.")
+fast_mode = st.toggle("⚡ Fast mode", value=True,
+                      help="Look where the barcode and code usually print first. Turn off for unusual crops.")
 uploaded_file = st.file_uploader("Upload Image", key="api_uploader")
 
 if uploaded_file:
     try:
-        image = Image.open(uploaded_file)
-        image = ImageOps.exif_transpose(image)
-        if image.width > 1000:
-            image.thumbnail((1000, 1000))
+        file_bytes = uploaded_file.getvalue()
+        # A new photo starts a fresh card, so nothing from the last one carries over
+        if st.session_state.get('scan_id') != uploaded_file.file_id:
+            st.session_state['scan_id'] = uploaded_file.file_id
+            st.session_state['upc_applied'] = False
+            # A wiki lookup still running for the previous photo belongs to that car
+            st.session_state.pop('wiki_future', None)
+            st.session_state['current_car'] = {
+                "title": "", "brand": "Hot Wheels", "image": "", "upc": "", "model_code": ""
+            }
+        image, _, found_upc = prepare_upload(file_bytes, fast_mode)
         
         st.image(image, caption="Scanning...", width=200)
-        
+
         # 1. UPC Scan
-        decoded_objects = decode(image)
-        if decoded_objects:
-            found_upc = decoded_objects[0].data.decode("utf-8")
+        upc_title = ""
+        if found_upc:
             st.caption(f"UPC: {found_upc}")
-            api_result = lookup_upc(found_upc)
-            st.session_state['current_car'].update(api_result)
-
-        # 2. Text Code Scan
-        found_code = extract_model_code(image)
-        if found_code:
-            st.success(f"🔹 Found Code: {found_code}")
-            st.session_state['current_car']['model_code'] = found_code
-            
-            # 3. ASK THE WIKI API
-            if not st.session_state['current_car']['title']:
-                with st.spinner(f"Asking Wiki Database for {found_code}..."):
-                    wiki_title, wiki_link = search_wiki_api(found_code)
-                    
-                    if wiki_title:
-                        st.balloons()
-                        st.success(f"✨ Identified: {wiki_title}")
-                        st.session_state['current_car']['title'] = wiki_title
-                        st.markdown(f"[View Wiki Page]({wiki_link})")
-                    else:
-                        st.warning("Code valid, but no exact Wiki match found.")
+            try:
+                api_result = submit_lookup(lookup_upc, found_upc).result()
+                upc_title = api_result['title']
+                # Fill the form once per photo; later reruns keep the user's edits
+                if not st.session_state['upc_applied']:
+                    st.session_state['current_car'].update(api_result)
+                    st.session_state['upc_applied'] = True
+            except Exception:
+                st.warning("UPC database unreachable, falling back to the model code.")
+                st.session_state['current_car']['upc'] = found_upc
+
+        # 2. Text Code Scan (OCR is the slow part, so only when the UPC didn't name the car)
+        if upc_title:
+            st.caption("Skipped OCR (UPC sufficed)")
+        else:
+            found_code = read_upload_code(file_bytes, fast_mode)
+            if found_code:
+                st.success(f"🔹 Found Code: {found_code}")
+                st.session_state['current_car']['model_code'] = found_code
+
+                # 3. ASK THE WIKI API (in the background, picked up below)
+                # Answers are kept per code and re-shown on every rerun
+                pending_code = st.session_state.get('wiki_future', (None, None))[0]
+                if found_code in st.session_state['wiki_results']:
+                    show_wiki_result(*st.session_state['wiki_results'][found_code])
+                elif pending_code != found_code:
+                    st.session_state['wiki_future'] = (
+                        found_code, submit_lookup(search_wiki_api, found_code)
+                    )
 
     except Exception as e:
         st.error(f"Error: {e}")
+else:
+    # Photo removed: don't let its pending wiki lookup fill in the form
+    st.session_state.pop('wiki_future', None)
+
+# --- WIKI RESULT ---
+# The form below stays usable while the lookup runs; we poll until it lands.
+if 'wiki_future' in st.session_state:
+    pending_code, wiki_future = st.session_state['wiki_future']
+    if wiki_future.done():
+        del st.session_state['wiki_future']
+        try:
+            wiki_title, wiki_link = wiki_future.result()
+        except Exception:
+            st.warning("Wiki lookup failed. It'll retry on your next change.")
+        else:
+            st.session_state['wiki_results'][pending_code] = (wiki_title, wiki_link)
+            if wiki_title:
+                st.balloons()
+            show_wiki_result(wiki_title, wiki_link)
+    else:
+        st.caption(f"⏳ Asking Wiki Database for {pending_code}...")
 
 # --- DISPLAY & EDIT ---
 car = st.session_state['current_car']
@@ -172,16 +374,33 @@ with col2:
     car['brand'] = new_brand
     car['model_code'] = new_code
 
-    if st.button("💾 Save to Collection"):
+    if st.button("➕ Add to Collection"):
         if not car['title']:
             st.error("Enter a Name first!")
         else:
-            success, msg = save_to_sheet(car)
-            if success:
-                st.success(msg)
-                st.session_state['current_car'] = {
-                    "title": "", "brand": "Hot Wheels", "image": "", "upc": "", "model_code": ""
-                }
-                st.rerun()
-            else:
-                st.warning(msg)
+            st.session_state['pending_rows'].append(build_row(car))
+            st.session_state.pop('scan_id', None)  # the still-uploaded photo fills the form again
+            if len(st.session_state['pending_rows']) >= AUTO_SYNC_AT:
+                st.session_state['auto_sync'] = True
+            st.session_state['current_car'] = {
+                "title": "", "brand": "Hot Wheels", "image": "", "upc": "", "model_code": ""
+            }
+            st.rerun()
+
+# --- PENDING QUEUE ---
+pending = st.session_state['pending_rows']
+if pending:
+    st.caption(f"🅿️ {len(pending)} car(s) waiting to be saved.")
+    if st.button(f"💾 Flush {len(pending)} cars") or st.session_state.pop('auto_sync', False):
+        success, msg = save_to_sheet(pending)
+        if success:
+            st.success(msg)
+            st.session_state['pending_rows'] = []
+        else:
+            st.warning(msg)
+
+# Keep polling the background wiki lookup. The sleep holds this run, so widget
+# events queue behind it for up to half a second.
+if 'wiki_future' in st.session_state:
+    time.sleep(0.5)
+    st.rerun()